@@ -1,20 +1,28 @@
 """
 Authentication classes for Spotify API
 """
-import os
 import base64
 import secrets
-import requests
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlencode, urlparse, parse_qs
+
+from spotify_watcher import json_utils
+from spotify_watcher.config import SpotifyConfig, config
+from spotify_watcher.http_client import session as _http
+
+
+def _basic_auth_header(client_id: str | None, client_secret: str | None) -> str:
+    """Build the HTTP Basic authorization header value for the client credentials"""
+    if not client_id or not client_secret:
+        raise ValueError("SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET must be set to request tokens")
+    credentials = f"{client_id}:{client_secret}"
+    return "Basic " + base64.urlsafe_b64encode(credentials.encode()).decode()
 
 
 class RequestUserAuthorization:
     """Handles the initial user authorization flow for Spotify API"""
     
-    def __init__(self):
-        self.client_id = os.getenv("SPOTIFY_CLIENT_ID")
-        self.user_id = os.getenv("SPOTIFY_USER_ID")
-        self.redirect_uri = os.getenv("SPOTIFY_REDIRECT_URI")
+    def __init__(self, cfg: SpotifyConfig = config):
+        self.cfg = cfg
     
     def get_authorization(self):
         """Generate authorization URL and handle the callback (not working in headless environments)"""
@@ -29,19 +37,21 @@ class RequestUserAuthorization:
         ])
         show_dialog = "false"
         
-        query = api_endpoint + \
-            f'response_type={response_type}&' + \
-            f'client_id={self.client_id}&' + \
-            f'scope={scope}&' + \
-            f'redirect_uri={self.redirect_uri}&' + \
-            f'state={state}&' + \
-            f'show_dialog={show_dialog}'
+        # urlencode escapes the space-separated scope list and redirect URI
+        query = api_endpoint + urlencode({
+            'response_type': response_type,
+            'client_id': self.cfg.client_id,
+            'scope': scope,
+            'redirect_uri': self.cfg.redirect_uri,
+            'state': state,
+            'show_dialog': show_dialog,
+        })
         
         print(f'State: {state}')
         print(query)
         return
         
-        response = requests.get(query)
+        response = _http.get(query)
 
         # Extract the code and state from the response
         parsed_url = urlparse(response.url)
@@ -58,29 +68,25 @@ class RequestUserAuthorization:
 class RequestAccessToken:
     """Handles exchanging authorization code for access token"""
     
-    def __init__(self):
-        self.client_id = os.getenv("SPOTIFY_CLIENT_ID")
-        self.client_secret = os.getenv("SPOTIFY_CLIENT_SECRET")
-        self.redirect_uri = os.getenv("SPOTIFY_REDIRECT_URI")
+    def __init__(self, cfg: SpotifyConfig = config):
+        self.cfg = cfg
+        self._auth_header = _basic_auth_header(cfg.client_id, cfg.client_secret)
 
     def get_access_token(self, auth_code=None) -> str:
         """Exchange authorization code for access token"""
-        self.code = auth_code or os.getenv("SPOTIFY_AUTH_CODE")
-
-        credentials = f"{self.client_id}:{self.client_secret}"
-        authorization = "Basic " + base64.urlsafe_b64encode(credentials.encode()).decode()
+        self.code = auth_code or self.cfg.auth_code
 
         api_endpoint = "https://accounts.spotify.com/api/token"
-        response = requests.post(
+        response = _http.post(
             api_endpoint,
             data={
                 "code": self.code,
-                "redirect_uri": self.redirect_uri,
+                "redirect_uri": self.cfg.redirect_uri,
                 "grant_type": "authorization_code",
             },
             headers={
                 "Content-Type": "application/x-www-form-urlencoded",
-                "Authorization": authorization
+                "Authorization": self._auth_header
             },
         )
 
@@ -88,32 +94,29 @@ class RequestAccessToken:
         if response.status_code != 200:
             raise Exception(f"Failed to get access token: {response.status_code} - {response.text}")
 
-        response_json = response.json()
+        response_json = json_utils.loads(response.content)
         return response_json["access_token"]
 
 
 class RefreshToken:
     """Handles refreshing access tokens using refresh token"""
     
-    def __init__(self):
-        self.refresh_token = os.getenv("SPOTIFY_REFRESH_TOKEN")
-        self.client_id = os.getenv("SPOTIFY_CLIENT_ID")
-        self.client_secret = os.getenv("SPOTIFY_CLIENT_SECRET")
+    def __init__(self, cfg: SpotifyConfig = config):
+        self.cfg = cfg
+        self._auth_header = _basic_auth_header(cfg.client_id, cfg.client_secret)
 
     def refresh(self) -> str:
         """Refresh the access token using the refresh token"""
         api_endpoint = "https://accounts.spotify.com/api/token"
-        credentials = f"{self.client_id}:{self.client_secret}"
-        authorization = "Basic " + base64.urlsafe_b64encode(credentials.encode()).decode()
         
-        response = requests.post(
+        response = _http.post(
             api_endpoint,
-            data={"grant_type": "refresh_token", "refresh_token": self.refresh_token},
-            headers={"Authorization": authorization},
+            data={"grant_type": "refresh_token", "refresh_token": self.cfg.refresh_token},
+            headers={"Authorization": self._auth_header},
         )
 
         if response.status_code != 200:
             raise Exception(f"Failed to refresh token: {response.status_code} - {response.text}")
 
-        response_json = response.json()
+        response_json = json_utils.loads(response.content)
         return response_json["access_token"]
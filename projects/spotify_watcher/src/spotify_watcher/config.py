@@ -0,0 +1,38 @@
+"""
+Configuration for the Spotify watcher, loaded once from the environment / .env file
+"""
+import os
+from dataclasses import dataclass
+from dotenv import load_dotenv
+
+
+@dataclass(frozen=True, slots=True)
+class SpotifyConfig:
+    """Immutable Spotify credentials and settings, safe to share between threads"""
+    client_id: str | None
+    client_secret: str | None
+    refresh_token: str | None
+    redirect_uri: str | None
+    user_id: str | None = None
+    auth_code: str | None = None
+    dump_json: bool = False
+    dump_json_pretty: bool = False
+
+    @classmethod
+    def from_env(cls) -> "SpotifyConfig":
+        """Build a config from the SPOTIFY_* environment variables"""
+        return cls(
+            client_id=os.getenv("SPOTIFY_CLIENT_ID"),
+            client_secret=os.getenv("SPOTIFY_CLIENT_SECRET"),
+            refresh_token=os.getenv("SPOTIFY_REFRESH_TOKEN"),
+            redirect_uri=os.getenv("SPOTIFY_REDIRECT_URI"),
+            user_id=os.getenv("SPOTIFY_USER_ID"),
+            auth_code=os.getenv("SPOTIFY_AUTH_CODE"),
+            dump_json=bool(os.getenv("SPOTIFY_WATCHER_DUMP_JSON")),
+            dump_json_pretty=bool(os.getenv("SPOTIFY_WATCHER_DUMP_JSON_PRETTY")),
+        )
+
+
+# Parse .env a single time at import; everything else reads from this object
+load_dotenv()
+config = SpotifyConfig.from_env()
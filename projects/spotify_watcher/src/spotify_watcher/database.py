@@ -2,68 +2,106 @@
 SQLite database handler for Spotify track history with automatic deduplication
 """
 import sqlite3
-from typing import List, Dict, Optional
+from contextlib import contextmanager
+from typing import List, Dict, Iterator, Optional
 from datetime import datetime
 import logging
+from operator import itemgetter
 
 logger = logging.getLogger(__name__)
 
+# Column order of the INSERT statement in insert_tracks_bulk
+TRACK_COLUMNS = (
+    'played_at', 'selfopticon_user_id', 'spotify_user_id', 'track_id', 'track_name',
+    'track_duration_ms', 'track_popularity', 'album_id', 'album_name',
+    'first_artist_id', 'first_artist_name', 'isrc'
+)
+
+
+def _adapt_datetime(value: datetime) -> str:
+    """Store datetimes as ISO-8601 text with a space separator (e.g. 2025-01-31 18:04:05.123000+00:00)"""
+    return value.isoformat(" ")
+
+
+def _played_at_text(value: datetime | str) -> str:
+    """Return played_at in the text form it is stored as"""
+    return _adapt_datetime(value) if isinstance(value, datetime) else value
+
+
+# Python 3.12 deprecates sqlite3's implicit datetime adapter, which also emits a warning per bound row.
+# Registering the same format explicitly keeps played_at comparable with existing rows and the
+# UNIQUE(played_at, ...) deduplication intact.
+sqlite3.register_adapter(datetime, _adapt_datetime)
+
+# Projects a track record dict onto an insert row tuple in a single C-level call
+_track_row = itemgetter(*TRACK_COLUMNS)
+
 
 class SpotifyTrackHistoryDB:
     """SQLite database handler for Spotify track history with automatic deduplication"""
     
     def __init__(self, db_path: str = "spotify_track_history.db"):
         self.db_path = db_path
+        # One long-lived connection in autocommit mode; transactions are opened explicitly
+        # and sqlite3's statement cache reuses prepared statements across calls
+        self._conn = sqlite3.connect(self.db_path, isolation_level=None, cached_statements=128)
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA temp_store=MEMORY")
+        self._conn.execute("PRAGMA mmap_size=268435456")
+        
+        # Newest stored played_at (as text) per user, loaded lazily and advanced on every insert
+        self._latest_played_at: Dict[str, Optional[str]] = {}
         self.init_database()
     
     def init_database(self):
         """Initialize the database and create tables if they don't exist"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Create the track history table with composite unique constraint
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS tbl_user_spotify_track_history (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        played_at DATETIME NOT NULL,
-                        selfopticon_user_id TEXT NOT NULL,
-                        spotify_user_id TEXT NOT NULL,
-                        track_id TEXT NOT NULL,
-                        track_name TEXT NOT NULL,
-                        track_duration_ms INTEGER NOT NULL,
-                        track_popularity INTEGER,
-                        album_id TEXT,
-                        album_name TEXT,
-                        first_artist_id TEXT,
-                        first_artist_name TEXT,
-                        isrc TEXT,
-                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                        
-                        -- Composite unique constraint for deduplication
-                        UNIQUE(played_at, selfopticon_user_id, track_id)
-                    )
-                """)
-                
-                # Create indexes for better query performance
-                cursor.execute("""
-                    CREATE INDEX IF NOT EXISTS idx_user_played_at 
-                    ON tbl_user_spotify_track_history(selfopticon_user_id, played_at DESC)
-                """)
-                
-                cursor.execute("""
-                    CREATE INDEX IF NOT EXISTS idx_track_id 
-                    ON tbl_user_spotify_track_history(track_id)
-                """)
-                
-                cursor.execute("""
-                    CREATE INDEX IF NOT EXISTS idx_artist_id 
-                    ON tbl_user_spotify_track_history(first_artist_id)
-                """)
-                
-                conn.commit()
-                logger.info(f"Database initialized at {self.db_path}")
-                
+            # WAL is persistent per-database: one fsync per commit and readers don't block writers
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            
+            cursor = self._conn.cursor()
+            
+            # Create the track history table with composite unique constraint
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS tbl_user_spotify_track_history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    played_at DATETIME NOT NULL,
+                    selfopticon_user_id TEXT NOT NULL,
+                    spotify_user_id TEXT NOT NULL,
+                    track_id TEXT NOT NULL,
+                    track_name TEXT NOT NULL,
+                    track_duration_ms INTEGER NOT NULL,
+                    track_popularity INTEGER,
+                    album_id TEXT,
+                    album_name TEXT,
+                    first_artist_id TEXT,
+                    first_artist_name TEXT,
+                    isrc TEXT,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    
+                    -- Composite unique constraint for deduplication
+                    UNIQUE(played_at, selfopticon_user_id, track_id)
+                )
+            """)
+            
+            # Create indexes for better query performance
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_user_played_at 
+                ON tbl_user_spotify_track_history(selfopticon_user_id, played_at DESC)
+            """)
+            
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_track_id 
+                ON tbl_user_spotify_track_history(track_id)
+            """)
+            
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_artist_id 
+                ON tbl_user_spotify_track_history(first_artist_id)
+            """)
+            
+            logger.info(f"Database initialized at {self.db_path}")
+            
         except sqlite3.Error as e:
             logger.error(f"Error initializing database: {e}")
             raise
@@ -74,6 +112,7 @@ class SpotifyTrackHistoryDB:
         
         Args:
             tracks (List[Dict]): List of track history records from parse_track_history()
+                                 (every key in TRACK_COLUMNS must be present, optional ones may be None)
             
         Returns:
             int: Number of new records inserted (duplicates are ignored)
@@ -82,50 +121,133 @@ class SpotifyTrackHistoryDB:
             return 0
         
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Prepare the INSERT OR IGNORE statement for deduplication
-                insert_sql = """
-                    INSERT OR IGNORE INTO tbl_user_spotify_track_history 
-                    (played_at, selfopticon_user_id, spotify_user_id, track_id, track_name, 
-                     track_duration_ms, track_popularity, album_id, album_name, 
-                     first_artist_id, first_artist_name, isrc)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """
-                
-                # Convert track records to tuples for bulk insert
-                track_tuples = []
-                for track in tracks:
-                    
-                    track_tuple = (
-                        track['played_at'],
-                        track['selfopticon_user_id'],
-                        track['spotify_user_id'],
-                        track['track_id'],
-                        track['track_name'],
-                        track['track_duration_ms'],
-                        track.get('track_popularity'),
-                        track.get('album_id'),
-                        track.get('album_name'),
-                        track.get('first_artist_id'),
-                        track.get('first_artist_name'),
-                        track.get('isrc')
-                    )
-                    track_tuples.append(track_tuple)
-                
-                # Execute bulk insert
-                cursor.executemany(insert_sql, track_tuples)
-                inserted_count = cursor.rowcount
-                conn.commit()
+            cursor = self._conn.cursor()
+            
+            # Prepare the INSERT OR IGNORE statement for deduplication
+            insert_sql = """
+                INSERT OR IGNORE INTO tbl_user_spotify_track_history 
+                (played_at, selfopticon_user_id, spotify_user_id, track_id, track_name, 
+                 track_duration_ms, track_popularity, album_id, album_name, 
+                 first_artist_id, first_artist_name, isrc)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """
+            
+            # Execute bulk insert in a single explicit transaction
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                # In steady-state polling most fetched tracks are already stored, so drop them up front
+                new_tracks = self._filter_existing_tracks(cursor, tracks)
                 
-                logger.info(f"Inserted {inserted_count} new track records (out of {len(tracks)} total)")
-                return inserted_count
+                inserted_count = 0
+                if new_tracks:
+                    # Stream track records to sqlite3 as tuples; executemany accepts any iterable
+                    cursor.executemany(insert_sql, map(_track_row, new_tracks))
+                    inserted_count = cursor.rowcount
+                cursor.execute("COMMIT")
                 
+                for track in new_tracks:
+                    played_at = _played_at_text(track['played_at'])
+                    latest = self._latest_played_at.get(track['selfopticon_user_id'])
+                    if latest is None or played_at > latest:
+                        self._latest_played_at[track['selfopticon_user_id']] = played_at
+            except Exception:
+                # Rows are built lazily, so a malformed record can fail mid-transaction too
+                cursor.execute("ROLLBACK")
+                raise
+            
+            logger.info(f"Inserted {inserted_count} new track records (out of {len(tracks)} total)")
+            return inserted_count
+            
         except sqlite3.Error as e:
             logger.error(f"Error inserting tracks: {e}")
             raise
     
+    def _filter_existing_tracks(self, cursor: sqlite3.Cursor, tracks: List[Dict]) -> List[Dict]:
+        """
+        Remove records that are already stored
+        
+        Records played after the user's newest stored track cannot be duplicates and skip the
+        lookup entirely; the rest are checked with one range query per user.
+        
+        Args:
+            cursor (sqlite3.Cursor): Cursor inside the insert transaction
+            tracks (List[Dict]): Track history records to check
+            
+        Returns:
+            List[Dict]: Records whose (played_at, selfopticon_user_id, track_id) key is not yet stored
+        """
+        tracks_by_user = {}
+        for track in tracks:
+            tracks_by_user.setdefault(track['selfopticon_user_id'], []).append(track)
+        
+        new_tracks = []
+        for selfopticon_user_id, user_tracks in tracks_by_user.items():
+            if selfopticon_user_id not in self._latest_played_at:
+                self._latest_played_at[selfopticon_user_id] = self._select_latest_played_at(cursor, selfopticon_user_id)
+            latest = self._latest_played_at[selfopticon_user_id]
+            
+            # Compare in the stored text form so keys match what the UNIQUE constraint sees
+            older = []
+            for track in user_tracks:
+                key = (_played_at_text(track['played_at']), track['track_id'])
+                if latest is None or key[0] > latest:
+                    new_tracks.append(track)
+                else:
+                    older.append((track, key))
+            
+            if not older:
+                continue
+            
+            # Out-of-order rows (overlapping polls, backfills) may still be new, so look them up
+            cursor.execute("""
+                SELECT played_at, track_id 
+                FROM tbl_user_spotify_track_history 
+                WHERE selfopticon_user_id = ? 
+                AND played_at >= ?
+                AND played_at <= ?
+            """, (selfopticon_user_id, min(key[0] for _, key in older), latest))
+            existing = set(cursor.fetchall())
+            
+            new_tracks.extend(track for track, key in older if key not in existing)
+        
+        return new_tracks
+    
+    @contextmanager
+    def bulk_load(self) -> Iterator["SpotifyTrackHistoryDB"]:
+        """
+        Temporarily trade durability for speed during one-shot backfills
+        
+        Switches to an in-memory rollback journal with synchronous=OFF and restores
+        WAL / synchronous=NORMAL on exit. A crash mid-load can corrupt the whole database
+        file, so only use this to fill an empty database that can be recreated.
+        
+        Leaving WAL needs exclusive access; if another connection holds the database open,
+        the settings are left unchanged and the load runs with normal durability. Re-entering
+        WAL needs the same, so if a reader opened the file during the load only synchronous=NORMAL
+        is restored and WAL comes back with the next connection.
+        
+        Yields:
+            SpotifyTrackHistoryDB: This database handler
+        """
+        try:
+            self._conn.execute("PRAGMA journal_mode=MEMORY")
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Bulk load mode unavailable, inserting with normal durability: {e}")
+            yield self
+            return
+        
+        self._conn.execute("PRAGMA synchronous=OFF")
+        try:
+            yield self
+        finally:
+            # Restore synchronous first so later writes are durable even if WAL can't be re-entered
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            try:
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.OperationalError as e:
+                # A reader opened the file during the load; the next connection re-enables WAL in init_database
+                logger.warning(f"Could not switch back to WAL mode after bulk load: {e}")
+    
     def get_latest_played_at(self, selfopticon_user_id: str) -> Optional[datetime]:
         """
         Get the latest played_at timestamp for a user to determine where to resume fetching
@@ -137,24 +259,37 @@ class SpotifyTrackHistoryDB:
             datetime | None: Latest played_at timestamp or None if no records exist
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute("""
-                    SELECT MAX(played_at) 
-                    FROM tbl_user_spotify_track_history 
-                    WHERE selfopticon_user_id = ?
-                """, (selfopticon_user_id,))
-                
-                result = cursor.fetchone()
-                if result and result[0]:
-                    return datetime.fromisoformat(result[0])
-                return None
-                
+            played_at = self._select_latest_played_at(self._conn.cursor(), selfopticon_user_id)
+            if played_at:
+                return datetime.fromisoformat(played_at)
+            return None
+            
         except sqlite3.Error as e:
             logger.error(f"Error getting latest played_at: {e}")
             raise
     
+    def _select_latest_played_at(self, cursor: sqlite3.Cursor, selfopticon_user_id: str) -> Optional[str]:
+        """
+        Get a user's newest stored played_at in its raw text form
+        
+        Args:
+            cursor (sqlite3.Cursor): Cursor to run the query on
+            selfopticon_user_id (str): User ID to check
+            
+        Returns:
+            str | None: Stored played_at text or None if no records exist
+        """
+        # Seek to the head of idx_user_played_at and stop after one row
+        cursor.execute("""
+            SELECT played_at 
+            FROM tbl_user_spotify_track_history 
+            WHERE selfopticon_user_id = ?
+            ORDER BY played_at DESC 
+            LIMIT 1
+        """, (selfopticon_user_id,))
+        result = cursor.fetchone()
+        return result[0] if result else None
+    
     def get_track_count(self, selfopticon_user_id: str = None) -> int:
         """
         Get total number of tracks for a user (or all users if None)
@@ -166,20 +301,19 @@ class SpotifyTrackHistoryDB:
             int: Number of track records
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                if selfopticon_user_id:
-                    cursor.execute("""
-                        SELECT COUNT(*) 
-                        FROM tbl_user_spotify_track_history 
-                        WHERE selfopticon_user_id = ?
-                    """, (selfopticon_user_id,))
-                else:
-                    cursor.execute("SELECT COUNT(*) FROM tbl_user_spotify_track_history")
-                
-                return cursor.fetchone()[0]
-                
+            cursor = self._conn.cursor()
+            
+            if selfopticon_user_id:
+                cursor.execute("""
+                    SELECT COUNT(*) 
+                    FROM tbl_user_spotify_track_history 
+                    WHERE selfopticon_user_id = ?
+                """, (selfopticon_user_id,))
+            else:
+                cursor.execute("SELECT COUNT(*) FROM tbl_user_spotify_track_history")
+            
+            return cursor.fetchone()[0]
+            
         except sqlite3.Error as e:
             logger.error(f"Error getting track count: {e}")
             raise
@@ -196,20 +330,19 @@ class SpotifyTrackHistoryDB:
             List[Dict]: List of recent track records
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row  # Enable dict-like access
-                cursor = conn.cursor()
-                
-                cursor.execute("""
-                    SELECT * FROM tbl_user_spotify_track_history 
-                    WHERE selfopticon_user_id = ?
-                    ORDER BY played_at DESC 
-                    LIMIT ?
-                """, (selfopticon_user_id, limit))
-                
-                rows = cursor.fetchall()
-                return [dict(row) for row in rows]
-                
+            cursor = self._conn.cursor()
+            cursor.row_factory = sqlite3.Row  # Enable dict-like access
+            
+            cursor.execute("""
+                SELECT * FROM tbl_user_spotify_track_history 
+                WHERE selfopticon_user_id = ?
+                ORDER BY played_at DESC 
+                LIMIT ?
+            """, (selfopticon_user_id, limit))
+            
+            rows = cursor.fetchall()
+            return [dict(row) for row in rows]
+            
         except sqlite3.Error as e:
             logger.error(f"Error getting recent tracks: {e}")
             raise
@@ -227,27 +360,37 @@ class SpotifyTrackHistoryDB:
             List[Dict]: List of top tracks with play counts
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                
-                cursor.execute("""
-                    SELECT track_name, first_artist_name, COUNT(*) as play_count
-                    FROM tbl_user_spotify_track_history 
-                    WHERE selfopticon_user_id = ? 
-                    AND played_at >= datetime('now', '-' || ? || ' days')
-                    GROUP BY track_id, track_name, first_artist_name
-                    ORDER BY play_count DESC 
-                    LIMIT ?
-                """, (selfopticon_user_id, days, limit))
-                
-                rows = cursor.fetchall()
-                return [dict(row) for row in rows]
-                
+            cursor = self._conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            
+            cursor.execute("""
+                SELECT MAX(track_name) AS track_name, 
+                       MAX(first_artist_name) AS first_artist_name, 
+                       COUNT(*) as play_count
+                FROM tbl_user_spotify_track_history 
+                WHERE selfopticon_user_id = ? 
+                AND played_at >= datetime('now', '-' || ? || ' days')
+                -- Unary + keeps the planner on the idx_user_played_at range search once
+                -- PRAGMA optimize has written statistics; otherwise it scans idx_track_id
+                GROUP BY +track_id
+                ORDER BY play_count DESC 
+                LIMIT ?
+            """, (selfopticon_user_id, days, limit))
+            
+            rows = cursor.fetchall()
+            return [dict(row) for row in rows]
+            
         except sqlite3.Error as e:
             logger.error(f"Error getting top tracks: {e}")
             raise
     
     def close(self):
-        """Close database connection (SQLite handles this automatically, but included for completeness)"""
-        pass
+        """Close the database connection, refreshing planner statistics first"""
+        self._conn.execute("PRAGMA optimize")
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,38 @@
+"""
+Shared HTTP clients for Spotify API requests
+"""
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def create_session() -> requests.Session:
+    """Create a requests session with a connection pool so TCP/TLS connections are kept alive between calls"""
+    session = requests.Session()
+    # Sessions only ever talk to one host, so one pool is enough
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=8, pool_block=True)
+    session.mount("https://", adapter)
+    return session
+
+
+def create_client(headers: dict | None = None) -> httpx.Client:
+    """Create an HTTP/2 client for the Spotify Web API, multiplexing requests over one keep-alive connection"""
+    return httpx.Client(
+        http2=True,
+        headers=headers,
+        timeout=10.0,
+        limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+    )
+
+
+def create_async_client() -> httpx.AsyncClient:
+    """Create an HTTP/2 async client for the Spotify Web API (use as an async context manager)"""
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=10.0,
+        limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+    )
+
+
+# Shared by the auth classes for their accounts.spotify.com token requests
+session = create_session()
@@ -0,0 +1,22 @@
+"""
+JSON helpers that use orjson when it is installed and fall back to the standard library
+"""
+try:
+    import orjson
+except ImportError:  # orjson is an optional speedup (pip install spotify_watcher[fast])
+    orjson = None
+    import json
+
+
+def loads(data: bytes | str):
+    """Parse a JSON document from bytes or str"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj, indent: bool = False) -> bytes:
+    """Serialize an object to UTF-8 encoded JSON bytes, optionally indented by 2 spaces"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, indent=2 if indent else None).encode()
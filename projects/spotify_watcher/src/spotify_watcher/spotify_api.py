@@ -1,10 +1,81 @@
 """
 Spotify API interaction classes
 """
-import requests
+import asyncio
+import logging
+import math
+import random
 import time
-from datetime import datetime
-from typing import List, Dict, Optional, Generator
+import httpx
+from datetime import UTC, datetime
+from email.utils import parsedate_to_datetime
+from typing import List, Dict, Optional, Generator, Iterator
+
+from spotify_watcher import json_utils
+from spotify_watcher.http_client import create_async_client, create_client
+
+logger = logging.getLogger(__name__)
+
+# Retries for rate-limited (429) and transient gateway (502/503/504) responses; a server-sent
+# Retry-After longer than MAX_BACKOFF fails the request rather than stalling the polling loop
+MAX_RETRIES = 5
+MAX_BACKOFF = 30
+
+
+def _parse_retry_after(value: str | None) -> float | None:
+    """
+    Parse a Retry-After header given either as delay-seconds or as an HTTP-date
+    
+    Args:
+        value (str | None): Raw header value
+        
+    Returns:
+        float | None: Seconds to wait (never negative), or None if the header is missing or malformed
+    """
+    if not value:
+        return None
+    try:
+        # Spotify sends delay-seconds
+        seconds = float(value)
+    except ValueError:
+        pass
+    else:
+        return max(seconds, 0.0) if math.isfinite(seconds) else None
+    try:
+        # Proxies and CDNs in front of the API may send an HTTP-date instead
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=UTC)
+    return max((retry_at - datetime.now(UTC)).total_seconds(), 0.0)
+
+
+def _retry_delay(response, attempt: int) -> float | None:
+    """
+    Seconds to wait before retrying a request, or None if the response should not be retried
+    
+    Args:
+        response (httpx.Response): Response to inspect
+        attempt (int): Zero-based attempt number, for exponential backoff
+        
+    Returns:
+        float | None: Delay in seconds including jitter, or None for a final response (including
+                      a Retry-After longer than MAX_BACKOFF, which is never retried early)
+    """
+    backoff = min(2 ** attempt, MAX_BACKOFF)
+    retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+    if response.status_code == 429 or (response.status_code == 503 and retry_after is not None):
+        if retry_after is not None and retry_after > MAX_BACKOFF:
+            # Retrying before the server allows would only extend the rate limit, so give up
+            logger.warning(f"Retry-After of {retry_after:.0f}s exceeds MAX_BACKOFF ({MAX_BACKOFF}s), not retrying")
+            return None
+        # Fall back to exponential backoff if the header is missing or unparseable
+        delay = backoff if retry_after is None else retry_after
+        return delay + random.uniform(0, 0.25)
+    if response.status_code in (502, 503, 504):
+        return backoff + random.random()
+    return None
 
 
 class GetRecentlyPlayed:
@@ -14,6 +85,43 @@ class GetRecentlyPlayed:
         self.access_token = access_token
         self.api_endpoint = "https://api.spotify.com/v1/me/player/recently-played"
         self.MAX_LIMIT = 50  # Spotify API limit for recently played tracks
+        
+        # Own HTTP/2 client so paginated calls share one multiplexed TLS connection to api.spotify.com
+        self._auth_headers = {"Authorization": f"Bearer {access_token}"}
+        self.client = create_client(headers=self._auth_headers)
+        
+        # Last response, replayed when Spotify answers a conditional GET with 304 Not Modified
+        self._etag = None
+        self._last_params = None
+        self._last_payload = None
+
+    def close(self):
+        """Close the HTTP client and release its pooled connections"""
+        self.client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _build_params(self, limit: int, after: str|int|None, before: str|int|None) -> dict:
+        """Validate the paging arguments and build the recently-played query parameters"""
+        # Check that limit is between 1 and MAX_LIMIT
+        if not (1 <= limit <= self.MAX_LIMIT):
+            raise ValueError(f"Limit must be between 1 and {self.MAX_LIMIT}")
+        
+        # Only one of after or before can be set
+        if after is not None and before is not None:
+            raise ValueError("Only one of 'after' or 'before' can be set")
+        
+        # Make sure after or before are integers
+        params = {"limit": limit}
+        if after is not None:
+            params["after"] = int(after)
+        if before is not None:
+            params["before"] = int(before)
+        return params
 
     def get_recently_played(self, limit=10, after: str|int=None, before: str|int=None) -> dict | None:
         """
@@ -31,40 +139,32 @@ class GetRecentlyPlayed:
             ValueError: If parameters are invalid
             Exception: If API request fails
         """
-        # Check that limit is between 1 and MAX_LIMIT
-        if not (1 <= limit <= self.MAX_LIMIT):
-            raise ValueError(f"Limit must be between 1 and {self.MAX_LIMIT}")
-        
-        # Only one of after or before can be set
-        if after is not None and before is not None:
-            raise ValueError("Only one of 'after' or 'before' can be set")
-        
-        # Make sure after or before are integers
-        if after is not None:
-            after = int(after)
-        if before is not None:
-            before = int(before)
+        params = self._build_params(limit, after, before)
 
-        headers = {
-            "Authorization": f"Bearer {self.access_token}"
-        }
-        
-        params = {"limit": limit}
-        if after is not None:
-            params["after"] = after
-        if before is not None:
-            params["before"] = before
+        # Only revalidate when asking for the same page as last time
+        headers = None
+        if self._etag is not None and params == self._last_params:
+            headers = {"If-None-Match": self._etag}
             
-        response = requests.get(self.api_endpoint, headers=headers, params=params)
+        for attempt in range(MAX_RETRIES + 1):
+            response = self.client.get(self.api_endpoint, headers=headers, params=params)
+            delay = _retry_delay(response, attempt)
+            if delay is None or attempt == MAX_RETRIES:
+                break
+            time.sleep(delay)
+
+        if response.status_code == 304:
+            return self._last_payload
 
         if response.status_code != 200:
             raise Exception(f"Failed to get recently played: {response.status_code} - {response.text}")
-            # TODO: Handle rate limiting (HTTP 429) and other potential errors
-            # See "Retry-After" header in response for rate limiting
-
 
-
-        response_json = response.json()
+        # Decode straight from the raw bytes, skipping the client's text decoding step
+        response_json = json_utils.loads(response.content)
+        
+        self._etag = response.headers.get("ETag")
+        self._last_params = params
+        self._last_payload = response_json
         return response_json
 
     def parse_track_history(self, spotify_response: dict, selfopticon_user_id: str, spotify_user_id: str) -> List[Dict]:
@@ -79,54 +179,64 @@ class GetRecentlyPlayed:
         Returns:
             List[Dict]: List of structured track history records matching the database schema
         """
-        track_history = []
+        return list(self._iter_parsed_tracks(spotify_response, selfopticon_user_id, spotify_user_id))
+
+    def _iter_parsed_tracks(self, spotify_response: dict, selfopticon_user_id: str, spotify_user_id: str) -> Iterator[Dict]:
+        """
+        Lazily parse Spotify API response items, so callers can filter while parsing
         
-        if not spotify_response or 'items' not in spotify_response:
-            return track_history
+        Args:
+            spotify_response (dict): Raw response from Spotify recently played API
+            selfopticon_user_id (str): Internal user ID for selfopticon system
+            spotify_user_id (str): Spotify user ID
+            
+        Yields:
+            Dict: Structured track history record matching the database schema
+        """
+        # The user IDs are the same for every record, so check them once rather than per item
+        if not spotify_response or 'items' not in spotify_response or selfopticon_user_id is None or spotify_user_id is None:
+            return
             
         for item in spotify_response['items']:
+            # Bind each nested object once (Spotify may send null for any of them)
+            track = item.get('track') or {}
+            
+            # Check the required fields first and skip the item before building anything
+            played_at_str = item.get('played_at')
+            track_id = track.get('id')
+            track_name = track.get('name')
+            track_duration_ms = track.get('duration_ms')
+            if not played_at_str or track_id is None or track_name is None or track_duration_ms is None:
+                continue
+            
+            # Parse played_at timestamp to datetime (fromisoformat accepts the trailing 'Z' since Python 3.11)
             try:
-                track = item.get('track', {})
-                album = track.get('album', {})
-                artists = track.get('artists', [])
-                
-                # Parse played_at timestamp to datetime
-                played_at_str = item.get('played_at')
-                played_at = datetime.fromisoformat(played_at_str.replace('Z', '+00:00')) if played_at_str else None
-                
-                # Get first artist info (if available)
-                first_artist_id = artists[0].get('id') if artists else None
-                first_artist_name = artists[0].get('name') if artists else None
-                
-                # Get ISRC (International Standard Recording Code)
-                external_ids = track.get('external_ids', {})
-                isrc = external_ids.get('isrc')
-                
-                record = {
-                    'played_at': played_at,
-                    'selfopticon_user_id': selfopticon_user_id,
-                    'spotify_user_id': spotify_user_id,
-                    'track_id': track.get('id'),
-                    'track_name': track.get('name'),
-                    'track_duration_ms': track.get('duration_ms'),
-                    'track_popularity': track.get('popularity'),
-                    'album_id': album.get('id'),
-                    'album_name': album.get('name'),
-                    'first_artist_id': first_artist_id,
-                    'first_artist_name': first_artist_name,
-                    'isrc': isrc
-                }
-                
-                # Only add records with required fields
-                if all(record[field] is not None for field in ['played_at', 'selfopticon_user_id', 'spotify_user_id', 'track_id', 'track_name', 'track_duration_ms']):
-                    track_history.append(record)
-                    
-            except Exception as e:
+                played_at = datetime.fromisoformat(played_at_str)
+            except ValueError as e:
                 # Log the error but continue processing other tracks
-                print(f"Error parsing track item: {e}")
+                logger.error(f"Error parsing played_at for track {track_id}: {e}")
                 continue
-                
-        return track_history
+            
+            album = track.get('album') or {}
+            artists = track.get('artists')
+            first_artist = (artists[0] if artists else None) or {}
+            
+            # Every TRACK_COLUMNS key must be present, since the database projects rows with an itemgetter
+            yield {
+                'played_at': played_at,
+                'selfopticon_user_id': selfopticon_user_id,
+                'spotify_user_id': spotify_user_id,
+                'track_id': track_id,
+                'track_name': track_name,
+                'track_duration_ms': track_duration_ms,
+                'track_popularity': track.get('popularity'),
+                'album_id': album.get('id'),
+                'album_name': album.get('name'),
+                'first_artist_id': first_artist.get('id'),
+                'first_artist_name': first_artist.get('name'),
+                # ISRC (International Standard Recording Code)
+                'isrc': (track.get('external_ids') or {}).get('isrc')
+            }
 
     def get_parsed_track_history(self, selfopticon_user_id: str, spotify_user_id: str, limit=10, after: str|int=None, before: str|int=None) -> List[Dict]:
         """
@@ -147,7 +257,7 @@ class GetRecentlyPlayed:
 
     def get_all_tracks_since(self, start_time: int, selfopticon_user_id: str, spotify_user_id: str, 
                            end_time: Optional[int] = None, limit: int = 50, 
-                           sleep_between_requests: float = 0.1) -> List[Dict]:
+                           sleep_between_requests: float = 0) -> List[Dict]:
         """
         Get all recently played tracks from start_time forward, handling pagination automatically.
         
@@ -158,7 +268,8 @@ class GetRecentlyPlayed:
             end_time (int, optional): Unix timestamp in milliseconds - stop fetching tracks after this time.
                                     If None, fetches until current time.
             limit (int): Number of tracks per API call (1-50, default 50 for efficiency)
-            sleep_between_requests (float): Seconds to sleep between API calls to respect rate limits
+            sleep_between_requests (float): Extra seconds to sleep between API calls (rate limiting is
+                                            otherwise handled by honoring Retry-After on HTTP 429)
             
         Returns:
             List[Dict]: List of all structured track history records from start_time to end_time
@@ -172,11 +283,14 @@ class GetRecentlyPlayed:
             
         if start_time >= end_time:
             raise ValueError("start_time must be before end_time")
+        
+        # Compare aware datetimes directly instead of converting every track to milliseconds
+        end_dt = datetime.fromtimestamp(end_time / 1000, tz=UTC)
             
         all_tracks = []
         current_after = start_time
         
-        print(f"Fetching tracks from {datetime.fromtimestamp(start_time/1000)} to {datetime.fromtimestamp(end_time/1000)}")
+        logger.debug(f"Fetching tracks from {datetime.fromtimestamp(start_time/1000)} to {datetime.fromtimestamp(end_time/1000)}")
         
         while True:
             try:
@@ -184,36 +298,29 @@ class GetRecentlyPlayed:
                 response = self.get_recently_played(limit=limit, after=current_after)
                 
                 if not response or 'items' not in response or not response['items']:
-                    # print("No more tracks found")
+                    logger.debug("No more tracks found")
                     break
                 
-                # Parse the tracks
-                parsed_tracks = self.parse_track_history(response, selfopticon_user_id, spotify_user_id)
-                
-                # Filter tracks that are within our time range
-                filtered_tracks = []
-                for track in parsed_tracks:
-                    track_time_ms = int(track['played_at'].timestamp() * 1000)
-                    if track_time_ms <= end_time:
-                        filtered_tracks.append(track)
-                    else:
-                        print(f"Reached end_time, stopping at track played at {track['played_at']}")
-                        all_tracks.extend(filtered_tracks)
+                # Parse and keep tracks within our time range in one pass, appending straight to the result
+                page_start = len(all_tracks)
+                for track in self._iter_parsed_tracks(response, selfopticon_user_id, spotify_user_id):
+                    if track['played_at'] > end_dt:
+                        logger.debug(f"Reached end_time, stopping at track played at {track['played_at']}")
                         return all_tracks
+                    all_tracks.append(track)
                 
-                all_tracks.extend(filtered_tracks)
-                print(f"Fetched {len(filtered_tracks)} tracks, total: {len(all_tracks)}")
+                logger.debug(f"Fetched {len(all_tracks) - page_start} tracks, total: {len(all_tracks)}")
                 
                 # Check if we have more data to fetch
                 if 'next' not in response or not response['next']:
-                    print("No next page available")
+                    logger.debug("No next page available")
                     break
                     
                 # Update cursor for next request
                 if 'cursors' in response and 'after' in response['cursors']:
                     current_after = int(response['cursors']['after'])
                 else:
-                    print("No after cursor found, stopping pagination")
+                    logger.debug("No after cursor found, stopping pagination")
                     break
                 
                 # Respect rate limits
@@ -221,14 +328,121 @@ class GetRecentlyPlayed:
                     time.sleep(sleep_between_requests)
                     
             except Exception as e:
-                print(f"Error during pagination: {e}")
+                logger.error(f"Error during pagination: {e}")
                 raise
                 
         return all_tracks
 
+    async def _aget_recently_played(self, client: httpx.AsyncClient, limit=10, after: str|int=None, before: str|int=None,
+                                    semaphore: Optional[asyncio.Semaphore] = None) -> dict:
+        """
+        Async counterpart of get_recently_played using a shared httpx.AsyncClient
+        
+        Args:
+            client (httpx.AsyncClient): Client created by http_client.create_async_client()
+            limit (int): Number of tracks to retrieve (1-50)
+            after (str|int): Unix timestamp - return tracks played after this time
+            before (str|int): Unix timestamp - return tracks played before this time
+            semaphore (asyncio.Semaphore, optional): Bounds in-flight requests across concurrent backfills
+            
+        Returns:
+            dict: JSON response from Spotify API containing recently played tracks
+        """
+        params = self._build_params(limit, after, before)
+        
+        for attempt in range(MAX_RETRIES + 1):
+            # The token is sent per request so one client can serve several users' backfills
+            if semaphore is None:
+                response = await client.get(self.api_endpoint, params=params, headers=self._auth_headers)
+            else:
+                async with semaphore:
+                    response = await client.get(self.api_endpoint, params=params, headers=self._auth_headers)
+            delay = _retry_delay(response, attempt)
+            if delay is None or attempt == MAX_RETRIES:
+                break
+            await asyncio.sleep(delay)
+
+        if response.status_code != 200:
+            raise Exception(f"Failed to get recently played: {response.status_code} - {response.text}")
+
+        return json_utils.loads(response.content)
+
+    async def aget_all_tracks_since(self, start_time: int, selfopticon_user_id: str, spotify_user_id: str,
+                                    end_time: Optional[int] = None, limit: int = 50,
+                                    client: Optional[httpx.AsyncClient] = None,
+                                    semaphore: Optional[asyncio.Semaphore] = None) -> List[Dict]:
+        """
+        Async version of get_all_tracks_since over an HTTP/2 httpx.AsyncClient.
+        
+        Pages are cursor-chained, so each backfill keeps one request in flight and fetches the
+        next page while parsing the current one. To backfill several users concurrently, pass
+        the same client and semaphore to each call and asyncio.gather() them.
+        
+        Args:
+            start_time (int): Unix timestamp in milliseconds - fetch tracks played after this time
+            selfopticon_user_id (str): Internal user ID for selfopticon system
+            spotify_user_id (str): Spotify user ID
+            end_time (int, optional): Unix timestamp in milliseconds - stop fetching tracks after this time.
+                                    If None, fetches until current time.
+            limit (int): Number of tracks per API call (1-50, default 50 for efficiency)
+            client (httpx.AsyncClient, optional): Shared client; a new one is created and closed if None
+            semaphore (asyncio.Semaphore, optional): Bounds in-flight requests across concurrent backfills
+            
+        Returns:
+            List[Dict]: List of all structured track history records from start_time to end_time
+            
+        Raises:
+            ValueError: If parameters are invalid
+            Exception: If API requests fail
+        """
+        if end_time is None:
+            end_time = int(time.time() * 1000)  # Current time in milliseconds
+            
+        if start_time >= end_time:
+            raise ValueError("start_time must be before end_time")
+        
+        if client is None:
+            async with create_async_client() as client:
+                return await self.aget_all_tracks_since(start_time, selfopticon_user_id, spotify_user_id,
+                                                        end_time=end_time, limit=limit,
+                                                        client=client, semaphore=semaphore)
+        
+        # Compare aware datetimes directly instead of converting every track to milliseconds
+        end_dt = datetime.fromtimestamp(end_time / 1000, tz=UTC)
+            
+        all_tracks = []
+        next_page = asyncio.create_task(
+            self._aget_recently_played(client, limit=limit, after=start_time, semaphore=semaphore))
+        
+        try:
+            while next_page is not None:
+                response = await next_page
+                next_page = None
+                
+                if not response or not response.get('items'):
+                    break
+                
+                # Follow the after cursor until Spotify reports no next page, requesting it
+                # before parsing this page so the round trip overlaps the parse
+                cursors = response.get('cursors') or {}
+                if response.get('next') and 'after' in cursors:
+                    next_page = asyncio.create_task(
+                        self._aget_recently_played(client, limit=limit, after=int(cursors['after']), semaphore=semaphore))
+                
+                for track in self._iter_parsed_tracks(response, selfopticon_user_id, spotify_user_id):
+                    if track['played_at'] > end_dt:
+                        return all_tracks
+                    all_tracks.append(track)
+        finally:
+            # Drop the prefetched page if we stopped early (end_time reached or an error)
+            if next_page is not None:
+                next_page.cancel()
+                
+        return all_tracks
+
     def paginate_tracks_generator(self, start_time: int, selfopticon_user_id: str, spotify_user_id: str,
                                 end_time: Optional[int] = None, limit: int = 50,
-                                sleep_between_requests: float = 0.1) -> Generator[List[Dict], None, None]:
+                                sleep_between_requests: float = 0) -> Generator[List[Dict], None, None]:
         """
         Generator that yields batches of tracks from start_time forward, handling pagination.
         Useful for processing large datasets without loading everything into memory.
@@ -240,7 +454,8 @@ class GetRecentlyPlayed:
             end_time (int, optional): Unix timestamp in milliseconds - stop fetching tracks after this time.
                                     If None, fetches until current time.
             limit (int): Number of tracks per API call (1-50, default 50 for efficiency)
-            sleep_between_requests (float): Seconds to sleep between API calls to respect rate limits
+            sleep_between_requests (float): Extra seconds to sleep between API calls (rate limiting is
+                                            otherwise handled by honoring Retry-After on HTTP 429)
             
         Yields:
             List[Dict]: Batch of structured track history records
@@ -254,10 +469,13 @@ class GetRecentlyPlayed:
             
         if start_time >= end_time:
             raise ValueError("start_time must be before end_time")
+        
+        # Compare aware datetimes directly instead of converting every track to milliseconds
+        end_dt = datetime.fromtimestamp(end_time / 1000, tz=UTC)
             
         current_after = start_time
         
-        print(f"Starting pagination from {datetime.fromtimestamp(start_time/1000)} to {datetime.fromtimestamp(end_time/1000)}")
+        logger.debug(f"Starting pagination from {datetime.fromtimestamp(start_time/1000)} to {datetime.fromtimestamp(end_time/1000)}")
         
         while True:
             try:
@@ -265,22 +483,18 @@ class GetRecentlyPlayed:
                 response = self.get_recently_played(limit=limit, after=current_after)
                 
                 if not response or 'items' not in response or not response['items']:
-                    print("No more tracks found")
+                    logger.debug("No more tracks found")
                     break
                 
-                # Parse the tracks
-                parsed_tracks = self.parse_track_history(response, selfopticon_user_id, spotify_user_id)
-                
                 # Filter tracks that are within our time range
                 filtered_tracks = []
                 should_stop = False
                 
-                for track in parsed_tracks:
-                    track_time_ms = int(track['played_at'].timestamp() * 1000)
-                    if track_time_ms <= end_time:
+                for track in self._iter_parsed_tracks(response, selfopticon_user_id, spotify_user_id):
+                    if track['played_at'] <= end_dt:
                         filtered_tracks.append(track)
                     else:
-                        print(f"Reached end_time, stopping at track played at {track['played_at']}")
+                        logger.debug(f"Reached end_time, stopping at track played at {track['played_at']}")
                         should_stop = True
                         break
                 
@@ -292,14 +506,14 @@ class GetRecentlyPlayed:
                 
                 # Check if we have more data to fetch
                 if 'next' not in response or not response['next']:
-                    print("No next page available")
+                    logger.debug("No next page available")
                     break
                     
                 # Update cursor for next request
                 if 'cursors' in response and 'after' in response['cursors']:
                     current_after = int(response['cursors']['after'])
                 else:
-                    print("No after cursor found, stopping pagination")
+                    logger.debug("No after cursor found, stopping pagination")
                     break
                 
                 # Respect rate limits
@@ -307,5 +521,5 @@ class GetRecentlyPlayed:
                     time.sleep(sleep_between_requests)
                     
             except Exception as e:
-                print(f"Error during pagination: {e}")
+                logger.error(f"Error during pagination: {e}")
                 raise